@@ -1,15 +1,22 @@
 import azure.functions as func
 import logging
-import json
 import os
-from datetime import datetime
-from typing import Optional, Dict, Any
+import asyncio
+import random
+import threading
+import hashlib
+import math
+from datetime import datetime, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+from typing import Optional, Dict, Any, Final, Callable, Awaitable
 
 # Import libraries
 from google import genai
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from pymongo import MongoClient
-import requests
+import httpx
+import orjson
 
 # Initialize FunctionApp
 app = func.FunctionApp()
@@ -24,61 +31,358 @@ MONGODB_CONNECTION_STRING = os.environ.get("MONGODB_CONNECTION_STRING")
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 
-# Initialize clients
-gemini_client = genai.Client(api_key=GEMINI_API_KEY)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-mongo_client = MongoClient(MONGODB_CONNECTION_STRING)
-db = mongo_client.agent_db
+# Initialize clients - khởi tạo lazy lần đầu được dùng (giữ lại cho cả worker),
+# để cold start không phải trả chi phí cho client mà function hiện tại không cần
+_clients: Dict[str, Any] = {}
+_client_locks: Dict[str, threading.Lock] = {}
+
+def _get_or_create_client(name: str, factory):
+    """Double-checked init: mỗi client chỉ được tạo một lần kể cả khi nhiều thread cùng gọi"""
+    client = _clients.get(name)
+    if client is None:
+        with _client_locks.setdefault(name, threading.Lock()):
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+def get_gemini() -> genai.Client:
+    """Gemini client dùng chung cho cả worker"""
+    return _get_or_create_client("gemini", lambda: genai.Client(api_key=GEMINI_API_KEY))
+
+def _log_supabase_response(response: httpx.Response):
+    """Event hook: log HTTP version để kiểm tra kết nối HTTP/2 keep-alive tới Supabase"""
+    logging.debug(f"Supabase {response.request.method} {response.url.path} via {response.http_version}")
+
+def get_supabase() -> Client:
+    """Supabase client dùng chung cho cả worker"""
+    return _get_or_create_client("supabase", _create_supabase_client)
+
+def _create_supabase_client() -> Client:
+    """Supabase client dùng httpx.Client (HTTP/2, keep-alive) sống suốt vòng đời worker"""
+    http_client = httpx.Client(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=10),
+        event_hooks={"response": [_log_supabase_response]}
+    )
+    return create_client(
+        SUPABASE_URL, SUPABASE_KEY,
+        options=ClientOptions(httpx_client=http_client)
+    )
+
+def get_mongo_client() -> MongoClient:
+    """MongoClient dùng chung cho cả worker, với connection pool cấu hình rõ ràng"""
+    return _get_or_create_client("mongo", lambda: MongoClient(
+        MONGODB_CONNECTION_STRING,
+        maxPoolSize=20,
+        minPoolSize=2,
+        maxIdleTimeMS=30000,
+        serverSelectionTimeoutMS=3000,
+        retryWrites=True
+    ))
+
+def get_db():
+    """Database agent_db; index được tạo ở lần truy cập đầu tiên"""
+    return _get_or_create_client("db", _create_db)
+
+def _create_db():
+    db = get_mongo_client().agent_db
+    # Tạo index ở thread nền để request/timer không phải chờ các lệnh create_index
+    threading.Thread(target=ensure_indexes, args=(db,), daemon=True).start()
+    return db
+
+# HTTP client dùng chung - giữ kết nối keep-alive (HTTP/2) tới api.telegram.org
+# giữa các lần invoke để không phải bắt tay TCP+TLS mỗi lần gửi tin
+TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=20)
+_ASYNC_HTTP = httpx.AsyncClient(http2=True, timeout=10.0, limits=_HTTP_LIMITS)
+
+# Số request Telegram đồng thời tối đa trong cả process (tránh bị 429)
+TELEGRAM_SEND_CONCURRENCY = 25
+# Số lần gửi lại khi Telegram trả 429 Too Many Requests
+TELEGRAM_MAX_RETRIES = 3
+# Retry-After lớn hơn mức này thì bỏ, tránh timer function chạy quá timeout
+TELEGRAM_MAX_RETRY_AFTER_SECONDS = 30
+_telegram_semaphore = asyncio.Semaphore(TELEGRAM_SEND_CONCURRENCY)
+
+# Cache embedding: LRU trong bộ nhớ + collection MongoDB (TTL 7 ngày) để dùng lại sau restart
+EMBEDDING_CACHE_SIZE = 2048
+EMBEDDING_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+# Gemini giới hạn tối đa 100 văn bản cho mỗi request embed
+EMBEDDING_BATCH_SIZE = 100
+
+# Semantic cache cho phản hồi AI: dùng lại câu trả lời nếu câu hỏi gần giống (cosine >= 0.95)
+RESPONSE_CACHE_THRESHOLD = 0.95
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Số entry gần nhất của chat được so sánh khi tìm cache; mỗi entry là vector 768 float
+# (~6 KB), nên giữ nhỏ để một lần miss không phải tải vài trăm KB từ MongoDB
+RESPONSE_CACHE_SCAN_LIMIT = 10
+
+# Giới hạn độ dài ngữ cảnh RAG đưa vào prompt (mỗi tài liệu và tổng cộng)
+RAG_DOC_MAX_CHARS = 800
+RAG_CONTEXT_MAX_CHARS = 3000
+
+AI_ERROR_RESPONSE = "Xin lỗi, tôi đang gặp sự cố kỹ thuật. Vui lòng thử lại sau."
+
+# Giữ reference tới các task chạy nền để không bị garbage collect giữa chừng
+_background_tasks = set()
+
+# Các lời gọi Gemini đang chạy, theo key - request giống hệt nhau sẽ chờ chung một task
+_inflight: Dict[str, asyncio.Task] = {}
+
+# Giờ Việt Nam và các khung giờ nhắc nhở của DailyReminder
+VN_TIMEZONE: Final = ZoneInfo("Asia/Ho_Chi_Minh")
+VN_REMINDER_HOURS: Final[frozenset] = frozenset({6, 12, 18, 21})
+DEFAULT_REMINDER_TIMES: Final[tuple] = ('06:00', '12:00', '18:00', '21:00')
+
+# ==================== STATIC MESSAGES ====================
+
+# Phản hồi cố định cho các lệnh, tạo một lần khi load module
+START_MESSAGE: Final[str] = """👋 *Xin chào! Tôi là AI Planning Assistant!*
+
+Tôi có thể giúp bạn:
+✅ Tạo kế hoạch tuần tự động
+✅ Nhắc nhở các mục tiêu hàng ngày
+✅ Tìm kiếm tài liệu và ghi chú
+✅ Theo dõi tiến độ công việc
+
+*Cách sử dụng:*
+Gửi mục tiêu của bạn cho tôi, ví dụ:
+"Tôi muốn học Python trong 2 tuần"
+
+Hoặc dùng các lệnh:
+/help - Xem hướng dẫn chi tiết
+/plan - Xem kế hoạch hiện tại"""
+
+HELP_MESSAGE: Final[str] = """📖 *Hướng Dẫn Sử Dụng*
+
+*1️⃣ Tạo Kế Hoạch:*
+Gửi mục tiêu của bạn, ví dụ:
+- "Tôi muốn học Python trong 2 tuần"
+- "Giúp tôi tập thể dục đều đặn"
+
+*2️⃣ Tìm Kiếm Tài Liệu:*
+Hỏi về bất kỳ chủ đề nào, tôi sẽ tìm trong tài liệu đã lưu.
+
+*3️⃣ Xem Kế Hoạch:*
+Gõ /plan để xem kế hoạch hiện tại
+
+*4️⃣ Tự Động Hóa:*
+- Kế hoạch tuần mới: Chủ nhật 9h sáng
+- Nhắc nhở hàng ngày: 4 lần (6h, 12h, 18h, 21h)
+- Databases được làm mới tự động
+
+Hãy bắt đầu bằng cách gửi mục tiêu của bạn! 🚀"""
+
+REMINDER_GREETINGS: Final[Dict[int, str]] = {
+    6: "☀️ *Chào Buổi Sáng!*",
+    12: "🌤️ *Nghỉ Trưa Rồi!*",
+    18: "🌆 *Buổi Chiều Vui Vẻ!*",
+    21: "🌙 *Buổi Tối An Lành!*"
+}
+
+INVALID_COMMAND_MESSAGE: Final[str] = """❓ *Lệnh không hợp lệ*
+
+Các lệnh có sẵn:
+/start - Bắt đầu
+/help - Hướng dẫn
+/plan - Xem kế hoạch
+
+Hoặc gửi tin nhắn bình thường để chat với tôi!"""
 
 # ==================== HELPER FUNCTIONS ====================
 
-def send_telegram_message(text: str, chat_id: str = None) -> bool:
-    """Gửi tin nhắn về Telegram"""
+_JSON_HEADERS = {"content-type": "application/json"}
+
+def _telegram_payload(text: str, chat_id: str = None) -> bytes:
+    """Tạo body JSON (encode bằng orjson) cho Telegram sendMessage"""
+    return orjson.dumps({
+        "chat_id": chat_id or TELEGRAM_CHAT_ID,
+        "text": text,
+        "parse_mode": "Markdown"
+    })
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """Thời gian chờ trước khi gửi lại, cộng thêm jitter.
+
+    Ưu tiên parameters.retry_after trong JSON body (theo Bot API), sau đó tới
+    header Retry-After, mặc định 1s. Trả về None nếu vượt quá
+    TELEGRAM_MAX_RETRY_AFTER_SECONDS.
+    """
+    retry_after = None
     try:
-        target_chat_id = chat_id or TELEGRAM_CHAT_ID
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": target_chat_id,
-            "text": text,
-            "parse_mode": "Markdown"
-        }
-        response = requests.post(url, json=payload)
+        retry_after = (orjson.loads(response.content).get("parameters") or {}).get("retry_after")
+    except (orjson.JSONDecodeError, AttributeError):
+        pass
+    if retry_after is None:
+        retry_after = response.headers.get("Retry-After", "1")
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 1.0
+    if delay > TELEGRAM_MAX_RETRY_AFTER_SECONDS:
+        return None
+    return delay + random.uniform(0, 0.25)
+
+async def send_telegram_message_async(text: str, chat_id: str = None) -> bool:
+    """Gửi tin nhắn về Telegram (async, dùng connection pool chung)"""
+    try:
+        payload = _telegram_payload(text, chat_id)
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            async with _telegram_semaphore:
+                response = await _ASYNC_HTTP.post(
+                    f"{TELEGRAM_API_URL}/sendMessage",
+                    content=payload,
+                    headers=_JSON_HEADERS
+                )
+            if response.status_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                break
+            delay = _retry_after_seconds(response)
+            if delay is None:
+                logging.warning("Telegram rate limited with a long Retry-After, giving up")
+                break
+            logging.warning(f"Telegram rate limited, retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
         return response.status_code == 200
     except Exception as e:
         logging.error(f"Error sending Telegram message: {e}")
         return False
 
+async def broadcast_telegram_messages(messages: list) -> list:
+    """Gửi song song nhiều tin nhắn Telegram, messages là list (text, chat_id)"""
+    async def _send(text: str, chat_id: str) -> bool:
+        # Jitter nhỏ để các request không dồn cùng một lúc
+        await asyncio.sleep(random.uniform(0, 0.05))
+        return await send_telegram_message_async(text, chat_id)
+
+    return await asyncio.gather(
+        *[_send(text, chat_id) for text, chat_id in messages],
+        return_exceptions=True
+    )
+
+def _extract_embedding(response) -> Optional[list]:
+    """Lấy vector embedding từ response của Gemini"""
+    if hasattr(response, 'embeddings') and response.embeddings:
+        embedding = response.embeddings[0]
+        if hasattr(embedding, 'values'):
+            return embedding.values
+        else:
+            return list(embedding)
+    elif hasattr(response, 'embedding'):
+        if hasattr(response.embedding, 'values'):
+            return response.embedding.values
+        else:
+            return list(response.embedding)
+    return None
+
+@lru_cache(maxsize=EMBEDDING_CACHE_SIZE)
+def _embed_cached(text: str) -> tuple:
+    """Tạo embedding có cache; trả về tuple để giá trị trong LRU không bị sửa"""
+    key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    # Tìm trong cache MongoDB trước khi gọi Gemini
+    try:
+        cached = get_db().embedding_cache.find_one({"_id": key})
+        if cached and cached.get('embedding'):
+            return tuple(cached['embedding'])
+    except Exception as e:
+        logging.warning(f"Error reading embedding cache: {e}")
+
+    response = get_gemini().models.embed_content(
+        model=EMBEDDING_MODEL,
+        contents=text
+    )
+    embedding = _extract_embedding(response)
+    if not embedding:
+        # Raise để lru_cache không lưu kết quả rỗng
+        raise ValueError("Empty embedding response")
+
+    try:
+        get_db().embedding_cache.update_one(
+            {"_id": key},
+            {"$set": {"embedding": list(embedding), "created_at": datetime.utcnow()}},
+            upsert=True
+        )
+    except Exception as e:
+        logging.warning(f"Error writing embedding cache: {e}")
+
+    return tuple(embedding)
+
 def create_embedding(text: str) -> Optional[list]:
     """Tạo embedding bằng Gemini"""
     try:
-        response = gemini_client.models.embed_content(
-            model="models/text-embedding-004",
-            contents=text
-        )
-        if hasattr(response, 'embeddings') and response.embeddings:
-            embedding = response.embeddings[0]
-            if hasattr(embedding, 'values'):
-                return embedding.values
-            else:
-                return list(embedding)
-        elif hasattr(response, 'embedding'):
-            if hasattr(response.embedding, 'values'):
-                return response.embedding.values
-            else:
-                return list(response.embedding)
-        return None
+        return list(_embed_cached(text))
     except Exception as e:
         logging.error(f"Error creating embedding: {e}")
         return None
 
-def search_rag_documents(query: str, threshold: float = 0.5, count: int = 3) -> list:
-    """Tìm kiếm tài liệu tương tự trong Supabase RAG"""
+def batch_create_embeddings(texts: list) -> list:
+    """Tạo embedding cho nhiều văn bản, mỗi request Gemini tối đa 100 văn bản (dùng khi nạp tài liệu RAG)"""
+    embeddings = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = texts[start:start + EMBEDDING_BATCH_SIZE]
+        response = get_gemini().models.embed_content(
+            model=EMBEDDING_MODEL,
+            contents=batch
+        )
+        if len(response.embeddings) != len(batch):
+            raise ValueError(
+                f"Expected {len(batch)} embeddings, got {len(response.embeddings)}"
+            )
+        embeddings.extend(list(embedding.values) for embedding in response.embeddings)
+    return embeddings
+
+def _cosine_similarity(a: list, b: list) -> float:
+    """Tính cosine similarity giữa hai vector"""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def find_cached_response(chat_id: str, query_embedding: list) -> Optional[str]:
+    """Tìm phản hồi đã cache cho câu hỏi gần giống của cùng user"""
+    try:
+        # TTL index có thể xoá trễ, nên vẫn lọc theo thời gian
+        since = datetime.utcnow() - timedelta(seconds=RESPONSE_CACHE_TTL_SECONDS)
+        entries = get_db().response_cache.find(
+            {"chat_id": chat_id, "created_at": {"$gte": since}},
+            {"embedding": 1, "reply": 1}
+        ).sort("created_at", -1).limit(RESPONSE_CACHE_SCAN_LIMIT)
+
+        best_reply, best_score = None, RESPONSE_CACHE_THRESHOLD
+        for entry in entries:
+            score = _cosine_similarity(query_embedding, entry.get('embedding', []))
+            if score >= best_score:
+                best_reply, best_score = entry.get('reply'), score
+
+        return best_reply
+    except Exception as e:
+        logging.error(f"Error reading response cache: {e}")
+        return None
+
+def save_cached_response(chat_id: str, message: str, query_embedding: list, reply: str):
+    """Lưu phản hồi AI vào semantic cache"""
+    try:
+        get_db().response_cache.insert_one({
+            "chat_id": chat_id,
+            "message": message,
+            "embedding": list(query_embedding),
+            "reply": reply,
+            "created_at": datetime.utcnow()
+        })
+    except Exception as e:
+        logging.error(f"Error saving response cache: {e}")
+
+def search_rag_documents(query_embedding: list, threshold: float = 0.5, count: int = 3) -> list:
+    """Tìm kiếm tài liệu tương tự trong Supabase RAG (embedding do caller tính sẵn)"""
     try:
-        query_embedding = create_embedding(query)
         if not query_embedding:
             return []
         
-        result = supabase.rpc(
+        result = get_supabase().rpc(
             "match_documents",
             {
                 "query_embedding": query_embedding,
@@ -109,19 +413,19 @@ Hãy trả lời ngắn gọn, hữu ích bằng tiếng Việt. Nếu người
 2. Đề xuất các bước thực hiện
 3. Khuyến khích họ"""
 
-        response = gemini_client.models.generate_content(
+        response = get_gemini().models.generate_content(
             model="gemini-2.0-flash-exp",
             contents=prompt
         )
         return response.text
     except Exception as e:
         logging.error(f"Error generating AI response: {e}")
-        return "Xin lỗi, tôi đang gặp sự cố kỹ thuật. Vui lòng thử lại sau."
+        return AI_ERROR_RESPONSE
 
 def save_user_message(chat_id: str, message: str):
     """Lưu tin nhắn người dùng vào MongoDB"""
     try:
-        db.user_messages.insert_one({
+        get_db().user_messages.insert_one({
             "chat_id": chat_id,
             "message": message,
             "timestamp": datetime.utcnow()
@@ -130,105 +434,111 @@ def save_user_message(chat_id: str, message: str):
     except Exception as e:
         logging.error(f"Error saving message: {e}")
 
-# ==================== FUNCTION 1: TELEGRAM WEBHOOK ====================
-
-@app.route(route="telegram", auth_level=func.AuthLevel.ANONYMOUS, methods=["POST"])
-def TelegramWebhook(req: func.HttpRequest) -> func.HttpResponse:
+def fetch_users_with_plans(plans_collection: str, plans_filter: dict, limit: int, sort: dict = None) -> list:
+    """Lấy tất cả user kèm danh sách plans (field "plans") bằng một aggregation $lookup duy nhất"""
+    plans_pipeline = [
+        {"$match": {"$expr": {"$eq": ["$chat_id", "$$cid"]}, **plans_filter}}
+    ]
+    if sort:
+        plans_pipeline.append({"$sort": sort})
+    plans_pipeline.append({"$limit": limit})
+
+    return list(get_db().user_profile.aggregate([
+        {"$match": {"chat_id": {"$ne": "temp"}}},
+        {"$lookup": {
+            "from": plans_collection,
+            "let": {"cid": "$chat_id"},
+            "pipeline": plans_pipeline,
+            "as": "plans"
+        }}
+    ]))
+
+def run_in_background(coro) -> asyncio.Task:
+    """Chạy coroutine dạng fire-and-forget trên event loop hiện tại"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _coalesced(key: str, fn, *args):
+    """Chạy fn trong thread; các lời gọi cùng key đang chạy đồng thời dùng chung kết quả"""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+        _inflight[key] = task
+        # Xoá khi xong (kể cả lỗi) để lần gọi sau chạy lại
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: một caller bị cancel không huỷ task của các caller khác
+    return await asyncio.shield(task)
+
+async def create_embedding_async(text: str) -> Optional[list]:
+    """create_embedding chạy nền, gộp các request trùng text đang chạy"""
+    key = "embed:" + hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return await _coalesced(key, create_embedding, text)
+
+async def generate_ai_response_async(user_message: str, context: str = "") -> str:
+    """generate_ai_response chạy nền, gộp các request trùng message + context đang chạy"""
+    key = "generate:" + hashlib.sha256(f"{user_message}\0{context}".encode('utf-8')).hexdigest()
+    return await _coalesced(key, generate_ai_response, user_message, context)
+
+def ensure_indexes(db):
+    """Tạo các index MongoDB cho những query hay dùng (create_index idempotent).
+
+    Chạy một lần mỗi worker trong thread nền, khởi động ở lần đầu get_db() được gọi.
     """
-    Function xử lý webhook từ Telegram
-    URL: /api/telegram
-    Method: POST
-    """
-    logging.info('🤖 Telegram webhook triggered')
-
-    try:
-        # Parse request body
-        req_body = req.get_json()
-        logging.info(f"Received: {json.dumps(req_body, ensure_ascii=False)}")
+    indexes = [
+        # TTL cho các collection cache tạo trước, để cache không phình ra nếu index khác lỗi
+        ("embedding_cache", "created_at", {"expireAfterSeconds": EMBEDDING_CACHE_TTL_SECONDS}),
+        ("response_cache", "created_at", {"expireAfterSeconds": RESPONSE_CACHE_TTL_SECONDS}),
+        # Semantic cache
+        ("response_cache", [("chat_id", 1), ("created_at", -1)], {}),
+        # /plan và DailyReminder
+        ("approved_plans", [("chat_id", 1), ("created_at", -1)], {}),
+        ("approved_plans", [("chat_id", 1), ("status", 1)], {}),
+        # WeeklyPlanner
+        ("pending_plans", [("chat_id", 1), ("status", 1)], {}),
+        ("user_messages", [("chat_id", 1), ("timestamp", -1)], {}),
+        # Có thể lỗi E11000 nếu đã có profile trùng chat_id
+        ("user_profile", "chat_id", {"unique": True}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            db[collection].create_index(keys, background=True, **options)
+        except Exception as e:
+            # Mỗi index tạo riêng để một index lỗi không bỏ qua các index còn lại;
+            # index lỗi sẽ được thử lại khi worker khởi động lại
+            logging.error(f"Error creating MongoDB index on {collection} {keys}: {e}")
+    logging.info("MongoDB index setup finished")
 
-        # Kiểm tra có message không
-        if 'message' not in req_body:
-            logging.info("No message in webhook")
-            return func.HttpResponse("OK", status_code=200)
+# ==================== FUNCTION 1: TELEGRAM WEBHOOK ====================
 
-        message = req_body['message']
-        chat_id = str(message.get('chat', {}).get('id', ''))
-        text = message.get('text', '')
+async def handle_plan_command(chat_id: str) -> str:
+    """Lệnh /plan: lấy 5 kế hoạch gần nhất từ MongoDB"""
+    # Lấy kế hoạch từ MongoDB (query chạy trong thread để không chặn event loop)
+    try:
+        plans = await asyncio.to_thread(lambda: list(get_db().approved_plans.find(
+            {"chat_id": chat_id}
+        ).sort("created_at", -1).limit(5)))
         
-        if not text:
-            logging.info("No text in message")
-            return func.HttpResponse("OK", status_code=200)
-
-        logging.info(f"📩 Chat ID: {chat_id}, Message: {text}")
-
-        # Lưu tin nhắn vào MongoDB
-        save_user_message(chat_id, text)
-
-        # Xử lý commands
-        if text.startswith('/'):
-            if text == '/start':
-                response_text = """👋 *Xin chào! Tôi là AI Planning Assistant!*
-
-Tôi có thể giúp bạn:
-✅ Tạo kế hoạch tuần tự động
-✅ Nhắc nhở các mục tiêu hàng ngày
-✅ Tìm kiếm tài liệu và ghi chú
-✅ Theo dõi tiến độ công việc
-
-*Cách sử dụng:*
-Gửi mục tiêu của bạn cho tôi, ví dụ:
-"Tôi muốn học Python trong 2 tuần"
-
-Hoặc dùng các lệnh:
-/help - Xem hướng dẫn chi tiết
-/plan - Xem kế hoạch hiện tại"""
+        if plans:
+            parts = ["📋 *Kế Hoạch Của Bạn:*\n\n"]
+            for i, plan in enumerate(plans, 1):
+                goal = plan.get('goal', 'N/A')
+                status = plan.get('status', 'pending')
+                created = plan.get('created_at', datetime.utcnow())
                 
-            elif text == '/help':
-                response_text = """📖 *Hướng Dẫn Sử Dụng*
-
-*1️⃣ Tạo Kế Hoạch:*
-Gửi mục tiêu của bạn, ví dụ:
-- "Tôi muốn học Python trong 2 tuần"
-- "Giúp tôi tập thể dục đều đặn"
-
-*2️⃣ Tìm Kiếm Tài Liệu:*
-Hỏi về bất kỳ chủ đề nào, tôi sẽ tìm trong tài liệu đã lưu.
-
-*3️⃣ Xem Kế Hoạch:*
-Gõ /plan để xem kế hoạch hiện tại
-
-*4️⃣ Tự Động Hóa:*
-- Kế hoạch tuần mới: Chủ nhật 9h sáng
-- Nhắc nhở hàng ngày: 4 lần (6h, 12h, 18h, 21h)
-- Databases được làm mới tự động
-
-Hãy bắt đầu bằng cách gửi mục tiêu của bạn! 🚀"""
+                # Format date
+                if isinstance(created, datetime):
+                    date_str = created.strftime('%d/%m/%Y')
+                else:
+                    date_str = 'N/A'
                 
-            elif text == '/plan':
-                # Lấy kế hoạch từ MongoDB
-                try:
-                    plans = list(db.approved_plans.find(
-                        {"chat_id": chat_id}
-                    ).sort("created_at", -1).limit(5))
-                    
-                    if plans:
-                        response_text = "📋 *Kế Hoạch Của Bạn:*\n\n"
-                        for i, plan in enumerate(plans, 1):
-                            goal = plan.get('goal', 'N/A')
-                            status = plan.get('status', 'pending')
-                            created = plan.get('created_at', datetime.utcnow())
-                            
-                            # Format date
-                            if isinstance(created, datetime):
-                                date_str = created.strftime('%d/%m/%Y')
-                            else:
-                                date_str = 'N/A'
-                            
-                            status_emoji = "✅" if status == "completed" else "🔄"
-                            response_text += f"{status_emoji} *{i}. {goal}*\n"
-                            response_text += f"   📅 {date_str} | Status: {status}\n\n"
-                    else:
-                        response_text = """📋 *Bạn chưa có kế hoạch nào*
+                status_emoji = "✅" if status == "completed" else "🔄"
+                parts.append(f"{status_emoji} *{i}. {goal}*\n")
+                parts.append(f"   📅 {date_str} | Status: {status}\n\n")
+            return "".join(parts)
+        else:
+            return """📋 *Bạn chưa có kế hoạch nào*
 
 Hãy gửi mục tiêu của bạn để tôi tạo kế hoạch!
 
@@ -236,72 +546,154 @@ Ví dụ:
 - "Tôi muốn học lập trình"
 - "Giúp tôi giảm cân trong 1 tháng"
 - "Làm sao để cải thiện tiếng Anh?\""""
-                        
-                except Exception as e:
-                    logging.error(f"Error fetching plans: {e}")
-                    response_text = "Xin lỗi, có lỗi khi lấy kế hoạch. Vui lòng thử lại."
-                    
-            else:
-                response_text = """❓ *Lệnh không hợp lệ*
+            
+    except Exception as e:
+        logging.error(f"Error fetching plans: {e}")
+        return "Xin lỗi, có lỗi khi lấy kế hoạch. Vui lòng thử lại."
+
+def _static_reply(message: str) -> Callable[[str], Awaitable[str]]:
+    """Handler cho lệnh có phản hồi cố định (không cần I/O)"""
+    async def handler(chat_id: str) -> str:
+        return message
+    return handler
+
+# Bảng dispatch cho các lệnh: command -> async handler(chat_id) trả về nội dung phản hồi
+COMMANDS: Final[Dict[str, Callable[[str], Awaitable[str]]]] = {
+    "/start": _static_reply(START_MESSAGE),
+    "/help": _static_reply(HELP_MESSAGE),
+    "/plan": handle_plan_command,
+}
+
+async def handle_message(chat_id: str, text: str):
+    """Xử lý tin nhắn Telegram và gửi phản hồi (chạy nền sau khi webhook đã trả 200)"""
+    try:
+        # Lưu tin nhắn vào MongoDB (chạy nền, không chặn việc tạo phản hồi)
+        run_in_background(asyncio.to_thread(save_user_message, chat_id, text))
 
-Các lệnh có sẵn:
-/start - Bắt đầu
-/help - Hướng dẫn
-/plan - Xem kế hoạch
+        # Embedding để lưu semantic cache sau khi gửi thành công (chỉ với phản hồi AI mới)
+        cache_embedding = None
 
-Hoặc gửi tin nhắn bình thường để chat với tôi!"""
+        # Xử lý commands
+        if text.startswith('/'):
+            handler = COMMANDS.get(text)
+            if handler:
+                response_text = await handler(chat_id)
+            else:
+                response_text = INVALID_COMMAND_MESSAGE
         
         else:
             # Tin nhắn thường - Tìm kiếm RAG và tạo phản hồi
             logging.info("Processing regular message with RAG")
             
-            # Tìm kiếm tài liệu liên quan
-            rag_results = search_rag_documents(text, threshold=0.3, count=2)
+            # Tạo embedding một lần, dùng cho cả semantic cache và RAG
+            query_embedding = await create_embedding_async(text)
             
-            context = ""
-            if rag_results:
-                logging.info(f"Found {len(rag_results)} RAG results")
-                context = "\n\n".join([
-                    f"- {doc['content']}" for doc in rag_results
-                ])
-            else:
-                logging.info("No RAG results found")
+            cached_reply = None
+            if query_embedding:
+                cached_reply = await asyncio.to_thread(
+                    find_cached_response, chat_id, query_embedding
+                )
             
-            # Tạo phản hồi AI
-            response_text = generate_ai_response(text, context)
+            if cached_reply:
+                logging.info("Semantic cache hit")
+                response_text = cached_reply
+            else:
+                # Tìm kiếm tài liệu liên quan
+                rag_results = []
+                if query_embedding:
+                    rag_results = await asyncio.to_thread(
+                        search_rag_documents, query_embedding, threshold=0.3, count=2
+                    )
+                
+                context = ""
+                if rag_results:
+                    logging.info(f"Found {len(rag_results)} RAG results")
+                    context = "\n\n".join(
+                        f"- {(doc.get('content') or '')[:RAG_DOC_MAX_CHARS]}" for doc in rag_results
+                    )[:RAG_CONTEXT_MAX_CHARS]
+                else:
+                    logging.info("No RAG results found")
+                
+                # Tạo phản hồi AI
+                response_text = await generate_ai_response_async(text, context)
+                
+                # Chỉ cache phản hồi hợp lệ (bỏ qua phản hồi lỗi và rỗng, ví dụ bị safety block)
+                if response_text and response_text != AI_ERROR_RESPONSE:
+                    cache_embedding = query_embedding
 
         # Gửi phản hồi về Telegram
-        success = send_telegram_message(response_text, chat_id)
+        success = await send_telegram_message_async(response_text, chat_id)
         
         if success:
             logging.info(f"✅ Response sent successfully to {chat_id}")
+            
+            # Lưu vào semantic cache (chạy nền) khi Telegram đã nhận phản hồi,
+            # để phản hồi bị từ chối (vd. Markdown lỗi) không bị dùng lại
+            if cache_embedding:
+                run_in_background(asyncio.to_thread(
+                    save_cached_response, chat_id, text, cache_embedding, response_text
+                ))
         else:
             logging.error(f"❌ Failed to send response to {chat_id}")
 
-        return func.HttpResponse("OK", status_code=200)
-
     except Exception as e:
-        logging.error(f"❌ Error in TelegramWebhook: {e}", exc_info=True)
+        logging.error(f"❌ Error handling message from {chat_id}: {e}", exc_info=True)
         
         # Cố gắng gửi error message về Telegram
         try:
-            if 'chat_id' in locals():
-                send_telegram_message(
-                    "Xin lỗi, có lỗi xảy ra. Vui lòng thử lại sau.",
-                    chat_id
-                )
+            await send_telegram_message_async(
+                "Xin lỗi, có lỗi xảy ra. Vui lòng thử lại sau.",
+                chat_id
+            )
         except:
             pass
+
+@app.route(route="telegram", auth_level=func.AuthLevel.ANONYMOUS, methods=["POST"])
+async def TelegramWebhook(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Function xử lý webhook từ Telegram
+    URL: /api/telegram
+    Method: POST
+    """
+    logging.info('🤖 Telegram webhook triggered')
+
+    try:
+        # Parse request body
+        req_body = orjson.loads(req.get_body())
+        logging.info(f"Received: {orjson.dumps(req_body).decode()}")
+
+        # Kiểm tra có message không
+        if 'message' not in req_body:
+            logging.info("No message in webhook")
+            return func.HttpResponse("OK", status_code=200)
+
+        message = req_body['message']
+        chat_id = str(message.get('chat', {}).get('id', ''))
+        text = message.get('text', '')
+        
+        if not text:
+            logging.info("No text in message")
+            return func.HttpResponse("OK", status_code=200)
+
+        logging.info(f"📩 Chat ID: {chat_id}, Message: {text}")
+
+        # Xử lý tin nhắn ở background để trả 200 cho Telegram ngay lập tức
+        run_in_background(handle_message(chat_id, text))
+
+        return func.HttpResponse("OK", status_code=200)
+
+    except Exception as e:
+        logging.error(f"❌ Error in TelegramWebhook: {e}", exc_info=True)
         
         return func.HttpResponse(
-            json.dumps({"error": str(e)}),
+            orjson.dumps({"error": str(e)}),
             status_code=200  # Trả 200 để Telegram không retry
         )
 
 # ==================== FUNCTION 2: WEEKLY PLANNER ====================
 
 @app.timer_trigger(schedule="0 0 9 * * 0", arg_name="myTimer", run_on_startup=False)
-def WeeklyPlanner(myTimer: func.TimerRequest) -> None:
+async def WeeklyPlanner(myTimer: func.TimerRequest) -> None:
     """
     Tạo kế hoạch tuần mới mỗi Chủ nhật 9h sáng
     Schedule: 0 0 9 * * 0 (Cron format: giây phút giờ ngày tháng thứ)
@@ -310,13 +702,16 @@ def WeeklyPlanner(myTimer: func.TimerRequest) -> None:
     logging.info('📅 WeeklyPlanner triggered')
     
     try:
-        # Lấy user profile từ MongoDB
-        users = list(db.user_profile.find({}))
+        # Lấy user profile kèm pending plans từ MongoDB (một query)
+        users = await asyncio.to_thread(
+            fetch_users_with_plans, "pending_plans", {"status": "pending"}, 5
+        )
         
         if not users:
             logging.warning("No users found in user_profile")
             return
         
+        sends = []
         for user in users:
             chat_id = user.get('chat_id')
             if not chat_id or chat_id == 'temp':
@@ -324,10 +719,7 @@ def WeeklyPlanner(myTimer: func.TimerRequest) -> None:
             
             logging.info(f"Creating weekly plan for user: {chat_id}")
             
-            # Lấy pending plans của user
-            pending_plans = list(db.pending_plans.find(
-                {"chat_id": chat_id, "status": "pending"}
-            ).limit(5))
+            pending_plans = user['plans']
             
             if not pending_plans:
                 # Gửi reminder để tạo kế hoạch
@@ -344,24 +736,32 @@ Ví dụ:
 
 Hãy bắt đầu tuần mới với mục tiêu rõ ràng! 💪"""
                 
-                send_telegram_message(message, chat_id)
+                sends.append((message, chat_id))
                 continue
             
             # Tạo tổng hợp kế hoạch
-            plan_summary = "📋 *Kế Hoạch Tuần Này:*\n\n"
+            parts = ["📋 *Kế Hoạch Tuần Này:*\n\n"]
             
             for i, plan in enumerate(pending_plans, 1):
                 goal = plan.get('goal', 'N/A')
-                plan_summary += f"{i}. {goal}\n"
+                parts.append(f"{i}. {goal}\n")
             
-            plan_summary += "\n💡 *Gợi ý:*\n"
-            plan_summary += "• Chia nhỏ mục tiêu thành các bước nhỏ\n"
-            plan_summary += "• Làm việc đều đặn mỗi ngày\n"
-            plan_summary += "• Theo dõi tiến độ và điều chỉnh kịp thời\n\n"
-            plan_summary += "Chúc bạn một tuần thành công! 🚀"
+            parts.append("\n💡 *Gợi ý:*\n")
+            parts.append("• Chia nhỏ mục tiêu thành các bước nhỏ\n")
+            parts.append("• Làm việc đều đặn mỗi ngày\n")
+            parts.append("• Theo dõi tiến độ và điều chỉnh kịp thời\n\n")
+            parts.append("Chúc bạn một tuần thành công! 🚀")
+            plan_summary = "".join(parts)
             
-            send_telegram_message(plan_summary, chat_id)
-            logging.info(f"✅ Weekly plan sent to {chat_id}")
+            sends.append((plan_summary, chat_id))
+        
+        # Gửi tất cả tin nhắn song song
+        results = await broadcast_telegram_messages(sends)
+        for (_, chat_id), result in zip(sends, results):
+            if result is True:
+                logging.info(f"✅ Weekly plan sent to {chat_id}")
+            else:
+                logging.error(f"❌ Failed to send weekly plan to {chat_id}: {result}")
         
         logging.info(f"✅ WeeklyPlanner completed for {len(users)} users")
         
@@ -372,7 +772,7 @@ Hãy bắt đầu tuần mới với mục tiêu rõ ràng! 💪"""
 # ==================== FUNCTION 3: DAILY REMINDER ====================
 
 @app.timer_trigger(schedule="0 0 6,12,18,21 * * *", arg_name="myTimer", run_on_startup=False)
-def DailyReminder(myTimer: func.TimerRequest) -> None:
+async def DailyReminder(myTimer: func.TimerRequest) -> None:
     """
     Gửi nhắc nhở hàng ngày 4 lần/ngày
     Schedule: 0 0 6,12,18,21 * * * 
@@ -381,38 +781,43 @@ def DailyReminder(myTimer: func.TimerRequest) -> None:
     logging.info('⏰ DailyReminder triggered')
     
     try:
-        current_hour = datetime.utcnow().hour + 7  # UTC+7 for Vietnam
-        if current_hour >= 24:
-            current_hour -= 24
+        current_hour = datetime.now(VN_TIMEZONE).hour
         
         logging.info(f"Current hour (Vietnam): {current_hour}")
         
-        # Lấy users từ MongoDB
-        users = list(db.user_profile.find({}))
+        # Ngoài các khung giờ nhắc nhở thì không cần query users
+        if current_hour not in VN_REMINDER_HOURS:
+            logging.info("Not a reminder hour, skipping")
+            return
+        
+        current_time = f"{current_hour:02d}:00"
+        
+        # Lấy users kèm approved plans chưa hoàn thành từ MongoDB (một query)
+        users = await asyncio.to_thread(
+            fetch_users_with_plans, "approved_plans",
+            {"status": {"$ne": "completed"}}, 3, {"created_at": -1}
+        )
         
         if not users:
             logging.warning("No users found in user_profile")
             return
         
+        sends = []
         for user in users:
             chat_id = user.get('chat_id')
             if not chat_id or chat_id == 'temp':
                 continue
             
             # Check xem có reminder_times không
-            reminder_times = user.get('reminder_times', ['06:00', '12:00', '18:00', '21:00'])
+            reminder_times = user.get('reminder_times', DEFAULT_REMINDER_TIMES)
             
             # Kiểm tra xem giờ hiện tại có trong reminder_times không
-            current_time = f"{current_hour:02d}:00"
             if current_time not in reminder_times:
                 continue
             
             logging.info(f"Sending reminder to user: {chat_id} at {current_time}")
             
-            # Lấy approved plans của user
-            plans = list(db.approved_plans.find(
-                {"chat_id": chat_id, "status": {"$ne": "completed"}}
-            ).limit(3))
+            plans = user['plans']
             
             if not plans:
                 # Không có kế hoạch, gửi reminder tạo kế hoạch
@@ -422,28 +827,29 @@ def DailyReminder(myTimer: func.TimerRequest) -> None:
 Bạn chưa có kế hoạch nào. Hãy bắt đầu ngày mới bằng cách đặt mục tiêu cho mình nhé!
 
 Gửi mục tiêu của bạn để tôi giúp tạo kế hoạch. 💪"""
-                    send_telegram_message(message, chat_id)
+                    sends.append((message, chat_id))
             else:
                 # Có kế hoạch, gửi reminder
-                time_messages = {
-                    6: "☀️ *Chào Buổi Sáng!*",
-                    12: "🌤️ *Nghỉ Trưa Rồi!*",
-                    18: "🌆 *Buổi Chiều Vui Vẻ!*",
-                    21: "🌙 *Buổi Tối An Lành!*"
-                }
+                greeting = REMINDER_GREETINGS.get(current_hour, "⏰ *Nhắc Nhở*")
                 
-                greeting = time_messages.get(current_hour, "⏰ *Nhắc Nhở*")
-                
-                message = f"{greeting}\n\n📋 *Kế Hoạch Hôm Nay:*\n\n"
+                parts = [f"{greeting}\n\n📋 *Kế Hoạch Hôm Nay:*\n\n"]
                 
                 for i, plan in enumerate(plans, 1):
                     goal = plan.get('goal', 'N/A')
-                    message += f"{i}. {goal}\n"
+                    parts.append(f"{i}. {goal}\n")
                 
-                message += "\n💪 Hãy tiếp tục cố gắng nhé!"
+                parts.append("\n💪 Hãy tiếp tục cố gắng nhé!")
+                message = "".join(parts)
                 
-                send_telegram_message(message, chat_id)
+                sends.append((message, chat_id))
+        
+        # Gửi tất cả nhắc nhở song song
+        results = await broadcast_telegram_messages(sends)
+        for (_, chat_id), result in zip(sends, results):
+            if result is True:
                 logging.info(f"✅ Reminder sent to {chat_id}")
+            else:
+                logging.error(f"❌ Failed to send reminder to {chat_id}: {result}")
         
         logging.info(f"✅ DailyReminder completed for {len(users)} users")
         
@@ -454,7 +860,7 @@ Gửi mục tiêu của bạn để tôi giúp tạo kế hoạch. 💪"""
 # ==================== FUNCTION 4: KEEP ALIVE ====================
 
 @app.timer_trigger(schedule="0 0 0 */5 * *", arg_name="myTimer", run_on_startup=False)
-def KeepAlive(myTimer: func.TimerRequest) -> None:
+async def KeepAlive(myTimer: func.TimerRequest) -> None:
     """
     Ping databases mỗi 5 ngày để tránh sleep
     Schedule: 0 0 0 */5 * * (Mỗi 5 ngày lúc 00:00)
@@ -462,20 +868,52 @@ def KeepAlive(myTimer: func.TimerRequest) -> None:
     logging.info('🔄 KeepAlive triggered')
     
     try:
-        # Ping MongoDB
-        mongo_result = db.command('ping')
-        logging.info(f"✅ MongoDB ping: {mongo_result}")
+        # Ping MongoDB, Supabase (query documents table) và Gemini API song song
+        mongo_result, supabase_result, gemini_result = await asyncio.gather(
+            asyncio.to_thread(lambda: get_db().command('ping')),
+            asyncio.to_thread(
+                lambda: get_supabase().table('documents').select('id').limit(1).execute()
+            ),
+            get_gemini().aio.models.generate_content(
+                model="gemini-2.0-flash-exp",
+                contents="Say 'OK' in one word"
+            ),
+            return_exceptions=True
+        )
         
-        # Ping Supabase bằng cách query documents table
-        supabase_result = supabase.table('documents').select('id').limit(1).execute()
-        logging.info(f"✅ Supabase ping: {len(supabase_result.data) if supabase_result.data else 0} records")
+        results = {
+            "MongoDB": mongo_result,
+            "Supabase": supabase_result,
+            "Gemini API": gemini_result
+        }
+        errors = {
+            name: result for name, result in results.items()
+            if isinstance(result, BaseException)
+        }
         
-        # Test Gemini API
-        test_response = gemini_client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents="Say 'OK' in one word"
-        )
-        logging.info(f"✅ Gemini ping: {test_response.text[:20]}")
+        if "MongoDB" not in errors:
+            logging.info(f"✅ MongoDB ping: {mongo_result}")
+        if "Supabase" not in errors:
+            logging.info(f"✅ Supabase ping: {len(supabase_result.data) if supabase_result.data else 0} records")
+        if "Gemini API" not in errors:
+            logging.info(f"✅ Gemini ping: {gemini_result.text[:20]}")
+        
+        if errors:
+            for name, error in errors.items():
+                logging.error(f"❌ {name} ping failed: {error}")
+            
+            status_lines = "\n".join(
+                f"❌ {name}: {str(errors[name])[:200]}" if name in errors else f"✅ {name}: OK"
+                for name in results
+            )
+            error_message = f"""⚠️ *KeepAlive Error*
+
+Có lỗi xảy ra khi ping databases:
+{status_lines}
+
+Vui lòng kiểm tra hệ thống!"""
+            await send_telegram_message_async(error_message)
+            return
         
         # Gửi thông báo về Telegram
         message = """🔄 *Hệ Thống Đang Hoạt Động*
@@ -486,7 +924,7 @@ def KeepAlive(myTimer: func.TimerRequest) -> None:
 
 Tất cả dịch vụ đang hoạt động bình thường! 💚"""
         
-        send_telegram_message(message)
+        await send_telegram_message_async(message)
         
         logging.info("✅ KeepAlive completed successfully")
         
@@ -501,6 +939,6 @@ Có lỗi xảy ra khi ping databases:
 {str(e)[:200]}
 
 Vui lòng kiểm tra hệ thống!"""
-            send_telegram_message(error_message)
+            await send_telegram_message_async(error_message)
         except:
             pass
\ No newline at end of file